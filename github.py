@@ -1,9 +1,16 @@
 """Compare latest PyPI release against GitHub commit log
 """
 
+import concurrent.futures
+import hashlib
+import sys
+import time
+
 import click
 import requests
-from github3 import login
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession, create_key
+from urllib3.util.retry import Retry
 
 
 GLOBAL_PACKAGES = [
@@ -16,30 +23,131 @@ GLOBAL_PACKAGES = [
     'react-invenio-forms',
 ]
 
+def cache_key(request, **kwargs):
+    """Cache key that also covers the Authorization token.
+
+    requests-cache leaves auth headers out of its keys; mixing in a hash of
+    the token keeps one token's responses from being served to another.
+    """
+    token = request.headers.get('Authorization', '')
+    digest = hashlib.sha256(token.encode()).hexdigest()[:16]
+    return digest + create_key(request, **kwargs)
+
+
+# Responses are kept on disk and revalidated with ETags once expired, so
+# unchanged upstream data costs a 304 instead of a full download.
+CACHE_OPTIONS = {
+    'backend': 'sqlite',
+    'use_cache_dir': True,
+    'cache_control': True,
+    'expire_after': 300,
+    'key_fn': cache_key,
+}
+
+
+GRAPHQL_ENDPOINT = 'https://api.github.com/graphql'
+
+# Field templates are formatted with the alias only; package specific
+# values are passed as GraphQL variables named after the alias.
+COMPARE_FIELD = '''repository(owner: $owner, name: ${alias}Name) {{
+  ref(qualifiedName: ${alias}Tag) {{
+    compare(headRef: "master") {{
+      commits(first: 100) {{ nodes {{ message }} pageInfo {{ hasNextPage }} }}
+    }}
+  }}
+}}
+'''
+
+PRS_FIELD = '''repository(owner: $owner, name: ${alias}Name) {{
+  pullRequests(states: OPEN, first: 100, orderBy: {{field: UPDATED_AT, direction: DESC}}) {{
+    nodes {{ number title assignees(first: 10) {{ nodes {{ login }} }} }}
+    pageInfo {{ hasNextPage }}
+  }}
+}}
+'''
+
+
+# (connect, read) timeouts in seconds for every registry and GitHub call.
+TIMEOUT = (4, 10)
+
+# Connections kept alive per host; also caps concurrent requests so no
+# worker ever waits on, or discards, a pooled connection.
+POOL_MAXSIZE = 16
+
+# Keep-alive connection pool that retries gateway errors, shared by all
+# sessions below.
+ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        # GraphQL queries are read-only POSTs, so retry those too.
+        allowed_methods=None,
+    ),
+)
+
+
+def mount_adapter(session):
+    """Mount the shared connection pool on a session."""
+    session.mount('http://', ADAPTER)
+    session.mount('https://', ADAPTER)
+    return session
+
+
+def graphql_cacheable(res):
+    """Only cache GraphQL results without errors (e.g. rate limiting)."""
+    return res.ok and not res.json().get('errors')
+
+
+SESSION = mount_adapter(CachedSession('rdm-scripts', **CACHE_OPTIONS))
+
+# GraphQL responses carry no ETag to revalidate against, so query results
+# are kept for a fixed time instead, keyed on the request body. This needs
+# its own backend: requests-cache keeps session settings on the backend.
+GRAPHQL_SESSION = mount_adapter(CachedSession(
+    'rdm-scripts-graphql',
+    backend='sqlite',
+    use_cache_dir=True,
+    allowable_methods=('POST',),
+    expire_after=300,
+    filter_fn=graphql_cacheable,
+    key_fn=cache_key,
+))
+
+
 class MarkdownFormatter:
     def commit_header(self):
-        print('| Package name | Version | Unreleased commits |')
-        print('|----|----|----|')
-
+        sys.stdout.write(
+            '| Package name | Version | Unreleased commits |\n'
+            '|----|----|----|\n'
+        )
 
     def commit_body(self, res):
-        print(f'| {res.name} | {res.pypi_version} | |')
-
-        for _dummy, headline in res:
-            print(f'| | | {headline} |')
+        rows = [f'| {res.name} | {res.pypi_version} | |']
+        rows += [f'| | | {headline} |' for _dummy, headline in res]
+        if res.truncated:
+            rows.append('| | | ... (truncated, see GitHub) |')
+        sys.stdout.write('\n'.join(rows) + '\n')
 
     def commit_footer(self):
         pass
 
     def pr_header(self):
-        print('| Package name | Assignee | Pull Request |')
-        print('|----|----|----|')
+        sys.stdout.write(
+            '| Package name | Assignee | Pull Request |\n'
+            '|----|----|----|\n'
+        )
 
     def pr_body(self, res):
-        print(f'| {res.name} | | |')
+        rows = [f'| {res.name} | | |']
         for p in res:
-            assignees = ", ".join([a.login for a in p.assignees]) or ''
-            print(f'| | {assignees} | #{p.number}: {p.title} |')
+            assignees = ", ".join(a['login'] for a in p['assignees']['nodes'])
+            rows.append(f'| | {assignees} | #{p["number"]}: {p["title"]} |')
+        if res.truncated:
+            rows.append('| | | ... (truncated, see GitHub) |')
+        sys.stdout.write('\n'.join(rows) + '\n')
 
     def pr_footer(self):
         pass
@@ -50,9 +158,11 @@ class TextFormatter:
         pass
 
     def commit_body(self, res):
-        print(f'- {res.name} (v{res.pypi_version})')
-        for _dummy, headline in res:
-            print(f'  - {headline}')
+        rows = [f'- {res.name} (v{res.pypi_version})']
+        rows += [f'  - {headline}' for _dummy, headline in res]
+        if res.truncated:
+            rows.append('  - ... (truncated, see GitHub)')
+        sys.stdout.write('\n'.join(rows) + '\n')
 
     def commit_footer(self):
         pass
@@ -61,10 +171,13 @@ class TextFormatter:
         pass
 
     def pr_body(self, res):
-        print(f'- {res.name}')
+        rows = [f'- {res.name}']
         for p in res:
-            assignees = ", ".join([a.login for a in p.assignees]) or 'UNASSIGNED'
-            print(f'  - #{p.number}: {p.title} ({assignees})')
+            assignees = ", ".join(a['login'] for a in p['assignees']['nodes']) or 'UNASSIGNED'
+            rows.append(f'  - #{p["number"]}: {p["title"]} ({assignees})')
+        if res.truncated:
+            rows.append('  - ... (truncated, see GitHub)')
+        sys.stdout.write('\n'.join(rows) + '\n')
 
     def pr_footer(self):
         pass
@@ -82,21 +195,21 @@ class FormatterFactory:
 
 
 class Comparison:
-    def __init__(self, name, pypi_version, commits):
+    def __init__(self, name, pypi_version, commits, truncated=False):
         self.name = name
         self.pypi_version = pypi_version
-        self.commits = commits
+        self.truncated = truncated
+        self._items = [(c, c['message'].partition('\n')[0]) for c in commits]
 
     def __iter__(self):
-        for c in self.commits.commits:
-            headline = c.message.split('\n')[0]
-            yield c, headline
+        return iter(self._items)
 
 
 class PRs:
-    def __init__(self, name, pulls):
+    def __init__(self, name, pulls, truncated=False):
         self.name = name
         self.pulls = pulls
+        self.truncated = truncated
 
     def __iter__(self):
         for p in self.pulls:
@@ -106,53 +219,150 @@ class PRs:
 def pypi_retrieve_info(package_name, client):
     """Retrieve information about latest PyPI release."""
     endpoint = f'https://pypi.org/pypi/{package_name}/json'
-    res = client.get(endpoint)
+    res = client.get(endpoint, timeout=TIMEOUT)
     if res.status_code == 200:
         return res.json()
     return None
 
 
 def npm_retrieve_info(package_name, client):
-    """Retrieve information about latest PyPI release."""
+    """Retrieve information about latest npm release."""
     endpoint = f'https://registry.npmjs.org/{package_name}'
-    res = client.get(endpoint)
+    # The abbreviated document only carries what installers need
+    # (dist-tags, versions) and is much smaller than the full packument.
+    res = client.get(
+        endpoint,
+        headers={'Accept': 'application/vnd.npm.install-v1+json'},
+        timeout=TIMEOUT,
+    )
     if res.status_code == 200:
         return res.json()
     return None
 
 
-def compare_pypi(name, gh, client):
-    pypi = pypi_retrieve_info(name, client)
-    pypi_version = pypi['info']['version']
+def retrieve_version(name, client):
+    """Retrieve latest released version from npm or PyPI."""
+    try:
+        if name.startswith('react-'):
+            return npm_retrieve_info(name, client)['dist-tags']['latest']
+        return pypi_retrieve_info(name, client)['info']['version']
+    except requests.RequestException as e:
+        raise click.ClickException(f'{name}: registry request failed: {e}') from e
 
-    repo = gh.repository('inveniosoftware', name)
 
-    return Comparison(
-        name,
-        pypi_version,
-        repo.compare_commits(f'v{pypi_version}', 'master'),
-    )
+def retrieve_versions(packages, client):
+    """Retrieve latest released versions of all packages concurrently."""
+    workers = min(len(packages), POOL_MAXSIZE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {p: executor.submit(retrieve_version, p, client) for p in packages}
+        return {p: f.result() for p, f in futures.items()}
 
-def compare_npm(name, gh, client):
-    pkg = npm_retrieve_info(name, client)
-    npm_version = pkg['dist-tags']['latest']
 
-    repo = gh.repository('inveniosoftware', name)
+def ratelimited(res):
+    """Whether GitHub refused the request because of a rate limit.
 
-    return Comparison(
-        name,
-        npm_version,
-        repo.compare_commits(f'v{npm_version}', 'master'),
-    )
+    Secondary limits answer 403/429, while an exhausted GraphQL budget is
+    a 200 with a ``RATE_LIMITED`` error.
+    """
+    if res.from_cache:
+        return False
+    exhausted = res.headers.get('X-RateLimit-Remaining') == '0'
+    if res.status_code in (403, 429):
+        return exhausted or 'Retry-After' in res.headers
+    if res.ok:
+        errors = res.json().get('errors') or []
+        return any(e.get('type') == 'RATE_LIMITED' for e in errors) or (
+            exhausted and bool(errors)
+        )
+    return False
 
 
-def list_prs(name, gh):
-    repo = gh.repository('inveniosoftware', name)
+def ratelimit_delay(res):
+    """Seconds until GitHub accepts requests again."""
+    if 'Retry-After' in res.headers:
+        return int(res.headers['Retry-After'])
+    reset = int(res.headers.get('X-RateLimit-Reset', time.time() + 60))
+    return max(0, reset - time.time())
 
-    return PRs(
-        name,
-        repo.pull_requests(state='open', sort='updated'),
-    )
+
+def wait(seconds, reason):
+    click.echo(f'{reason}, waiting {seconds:.0f}s...', err=True)
+    time.sleep(seconds)
+
+
+def graphql(token, template, params):
+    """Run a single GraphQL query made of one repository field per package.
+
+    ``params`` maps each package name to its extra string variables, which
+    ``template`` refers to as ``$<alias><key>``.
+    """
+    aliases = {f'r{i}': name for i, name in enumerate(params)}
+    variables = {'owner': 'inveniosoftware'}
+    for alias, name in aliases.items():
+        variables[f'{alias}Name'] = name
+        variables.update({f'{alias}{k}': v for k, v in params[name].items()})
+    declarations = ', '.join(f'${v}: String!' for v in variables)
+    query = f'query({declarations}) {{\n' + ''.join(
+        f'{alias}: ' + template.format(alias=alias) for alias in aliases
+    ) + '}'
+
+    def post():
+        try:
+            return GRAPHQL_SESSION.post(
+                GRAPHQL_ENDPOINT,
+                json={'query': query, 'variables': variables},
+                headers={'Authorization': f'bearer {token}'},
+                timeout=TIMEOUT,
+            )
+        except requests.RequestException as e:
+            raise click.ClickException(f'GitHub request failed: {e}') from e
+
+    res = post()
+    if ratelimited(res):
+        wait(ratelimit_delay(res), 'GitHub rate limit hit')
+        res = post()
+    try:
+        res.raise_for_status()
+    except requests.HTTPError as e:
+        raise click.ClickException(f'GitHub request failed: {e}') from e
+
+    body = res.json()
+    if body.get('errors'):
+        raise click.ClickException(body['errors'][0]['message'])
+    return {name: body['data'][alias] for alias, name in aliases.items()}
+
+
+def compare(token, versions):
+    params = {
+        name: {'Tag': f'refs/tags/v{version}'}
+        for name, version in versions.items()
+    }
+
+    results = {}
+    for name, repo in graphql(token, COMPARE_FIELD, params).items():
+        if repo['ref'] is None:
+            raise click.ClickException(f'{name}: tag v{versions[name]} not found.')
+        commits = repo['ref']['compare']['commits']
+        results[name] = Comparison(
+            name,
+            versions[name],
+            commits['nodes'],
+            truncated=commits['pageInfo']['hasNextPage'],
+        )
+    return results
+
+
+def list_prs(token, packages):
+    params = {name: {} for name in packages}
+
+    return {
+        name: PRs(
+            name,
+            repo['pullRequests']['nodes'],
+            truncated=repo['pullRequests']['pageInfo']['hasNextPage'],
+        )
+        for name, repo in graphql(token, PRS_FIELD, params).items()
+    }
 
 
 #
@@ -183,20 +393,15 @@ def unreleased(packages, format, token):
       python github.py unreleased -t <token> -f md invenio-records-resources
     """
     # Defaults
-    gh = login(token=token)
-    client = requests.Session()
     formatter = FormatterFactory.create(format)
     if not packages:
         packages = GLOBAL_PACKAGES
 
     # Compare and output
+    results = compare(token, retrieve_versions(packages, SESSION))
     formatter.commit_header()
     for p in sorted(packages):
-        if p.startswith('react-'):
-            res = compare_npm(p, gh, client)
-        else:
-            res = compare_pypi(p, gh, client)
-        formatter.commit_body(res)
+        formatter.commit_body(results[p])
     formatter.commit_footer()
 
 
@@ -215,15 +420,15 @@ def prs(packages, format, token):
       python github.py unreleased -t <token> -f md invenio-records-resources
     """
     # Defaults
-    gh = login(token=token)
     formatter = FormatterFactory.create(format)
     if not packages:
         packages = GLOBAL_PACKAGES
 
     # Compare and output
+    results = list_prs(token, packages)
     formatter.pr_header()
     for p in sorted(packages):
-        formatter.pr_body(list_prs(p, gh))
+        formatter.pr_body(results[p])
     formatter.pr_footer()
 
 if __name__ == '__main__':